@@ -458,11 +458,12 @@ def jittable(func):
     jitfunc.jittable = True
     return jitfunc
 
-def compile(sigstr):
+def compile(sigstr, **kw):
     """
-    Compile a function Ahead-Of-Time using the given signature string
+    Compile a function Ahead-Of-Time using the given signature string;
+    extra keyword arguments (e.g. fastmath=True) are passed to numba.njit
     """
-    return numba.njit(sigstr, error_model='numpy', cache=True)
+    return numba.njit(sigstr, error_model='numpy', cache=True, **kw)
 
 
 # used when reading _rates/sid
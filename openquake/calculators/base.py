@@ -843,9 +843,8 @@ class HazardCalculator(BaseCalculator):
                                      field_map=json.dumps(fieldmap))
             self.treaty_df = treaty_df
             # add policy_grp column
-            for _, pol in policy_df.iterrows():
-                grp = reinsurance.build_policy_grp(pol, treaty_df)
-                policy_acc['policy_grp'].append(grp)
+            policy_acc['policy_grp'].extend(
+                reinsurance.build_policy_grps(policy_df, treaty_df))
             for col in policy_df.columns:
                 policy_acc[col].extend(policy_df[col])
             policy_acc['loss_type'].extend([loss_type] * len(policy_df))
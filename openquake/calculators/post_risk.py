@@ -560,12 +560,20 @@ class PostRiskCalculator(base.RiskCalculator):
             ct = oq.concurrent_tasks or 1
 
             # now aggregate risk_by_event by policy
-            allargs = [(dstore, pdf, self.treaty_df, loss_id)
-                       for pdf in numpy.array_split(self.policy_df, ct)]
-            self.datastore.swmr_on()
-            smap = parallel.Starmap(reinsurance.reins_by_policy, allargs,
-                                    h5=self.datastore.hdf5)
-            rbp = pandas.concat(list(smap))
+            nrows = len(dstore['risk_by_event/agg_id'])
+            if (len(self.policy_df) < reinsurance.MIN_POLICIES or
+                    nrows < reinsurance.MIN_ROWS):
+                # small calculation, parallelizing would be slower
+                rbp = pandas.concat(list(reinsurance.reins_by_policy(
+                    dstore, self.policy_df, self.treaty_df, loss_id,
+                    self._monitor)))
+            else:
+                allargs = [(dstore, pdf, self.treaty_df, loss_id)
+                           for pdf in numpy.array_split(self.policy_df, ct)]
+                self.datastore.swmr_on()
+                smap = parallel.Starmap(reinsurance.reins_by_policy, allargs,
+                                        h5=self.datastore.hdf5)
+                rbp = pandas.concat(list(smap))
             if len(rbp) == 0:
                 raise ValueError('No data in risk_by_event for %r' % lt)
             rbe = reinsurance.by_event(rbp, self.treaty_df, self._monitor)
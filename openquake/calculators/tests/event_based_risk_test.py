@@ -25,6 +25,7 @@ from openquake.baselib.hdf5 import read_csv
 from openquake.baselib.writers import CsvWriter, FIVEDIGITS
 from openquake.hazardlib import InvalidFile
 from openquake.hazardlib.source.rupture import get_ruptures_aw
+from openquake.risklib import reinsurance
 from openquake.commonlib import logs, readinput
 from openquake.calculators.views import view, text_table
 from openquake.calculators.tests import CalculatorTestCase, strip_calc_id
@@ -639,6 +640,17 @@ agg_id
 
 class ReinsuranceTestCase(CalculatorTestCase):
 
+    def test_reinsurance_starmap(self):
+        # force the parallel path in post_risk, which is skipped by the
+        # other tests since they have few policies and rows
+        with mock.patch.object(reinsurance, 'MIN_POLICIES', 0), \
+             mock.patch.object(reinsurance, 'MIN_ROWS', 0):
+            self.run_calc(reinsurance_1.__file__, 'job.ini')
+        [fname] = export(('reinsurance-risk_by_event', 'csv'),
+                         self.calc.datastore)
+        self.assertEqualFiles('expected/reinsurance-risk_by_event.csv',
+                              fname, delta=1E-5)
+
     def test_reinsurance_gmfs(self):
         rf = "{'structural+nonstructural': 'no_reinsurance.xml'}"
         self.run_calc(reinsurance_1.__file__, 'job.ini', reinsurance_file=rf)
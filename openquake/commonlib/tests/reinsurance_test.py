@@ -22,6 +22,7 @@ import sys
 import shutil
 import unittest
 import tempfile
+from unittest import mock
 import numpy as np
 import pandas
 from openquake.baselib import general, InvalidFile
@@ -37,14 +38,14 @@ def _df(string, sep=',', index_col=None):
                            keep_default_na=False)
 
 
-def assert_ok(got, exp):
+def assert_ok(got, exp, rtol=1E-7):
     if len(got.columns) != len(exp.columns):
         raise ValueError('Different columns %s != %s' %
                          (got.columns, exp.columns))
     assert list(got.columns) == list(exp.columns)
     for col in got.columns:
         try:
-            aac(got[col], exp[col], err_msg=col)
+            aac(got[col], exp[col], rtol, err_msg=col)
         except ValueError:
             sys.exit(f'Wrong column {col} in {got}')
 
@@ -175,6 +176,24 @@ event_id,retention,claim,prop1,prop2,over_A
         assert_ok(byevent, expected)
 
 
+class ApplyTreatyTestCase(unittest.TestCase):
+    def check(self, n):
+        rng = np.random.default_rng(42)
+        retention = rng.uniform(0, 1000, n)
+        orig = retention.copy()
+        cession = np.full(n, -1.)  # the cession is overwritten
+        reinsurance.apply_treaty(cession, retention, 200., 500.)
+        exp = np.minimum(np.maximum(orig - 200., 0.), 500.)
+        aac(cession, exp)
+        aac(retention, orig - exp)
+
+    def test_serial(self):
+        self.check(reinsurance.MIN_PARALLEL - 1)
+
+    def test_parallel(self):
+        self.check(reinsurance.MIN_PARALLEL + 1000)
+
+
 class ReinsuranceTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -188,6 +207,35 @@ class ReinsuranceTestCase(unittest.TestCase):
                         'liability': 'Limit',
                         'policy': 'Policy'}
         cls.treaty_df = treaty_df
+        # check that cessions + retention == claim in by_event
+        cls.check = mock.patch.object(reinsurance, 'CHECK', True)
+        cls.check.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.check.stop()
+
+    def test_parse_cache(self):
+        csvfname = general.gettemp(CSV_NP)
+        xmlfname = general.gettemp(XML_NP.format(csvfname))
+        info = reinsurance._parse.cache_info
+        reinsurance._parse.cache_clear()
+        df1, _, _ = reinsurance.parse(xmlfname, policy_idx)
+        self.assertEqual((info().hits, info().misses), (0, 1))
+        df1['deductible'] = 0  # changing the result does not affect the cache
+        df2, _, _ = reinsurance.parse(xmlfname, policy_idx)
+        self.assertEqual((info().hits, info().misses), (1, 1))
+        self.assertEqual(list(df2.deductible), [100, 200, 500])
+        # changing the policy file invalidates the cache; the size does not
+        # change, so the mtime is set explicitly, not to depend on the
+        # granularity of the filesystem timestamps
+        st = os.stat(csvfname)
+        with open(csvfname, 'w') as f:
+            f.write(CSV_NP.replace('9000,500', '9000,600'))
+        os.utime(csvfname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        df3, _, _ = reinsurance.parse(xmlfname, policy_idx)
+        self.assertEqual((info().hits, info().misses), (1, 2))
+        self.assertEqual(list(df3.deductible), [100, 200, 600])
 
     def test_policy1(self):
         # VA_region_1, CatXL_reg(50, 2500)
@@ -233,6 +281,53 @@ event_id,policy_id,retention,claim,WXLR_metro,WXLR_rural
         del out['policy_grp']
         assert_ok(out, expected)
 
+    def test_round_output(self):
+        # losses with more than 6 digits
+        rbe = risk_by_event.copy()
+        rbe['loss'] /= 3
+        pol = dict(self.policy_df.loc[1])
+        exp = reinsurance.by_policy(rbe, pol, self.treaty_df)
+        with mock.patch.object(reinsurance, 'ROUND_OUTPUT', True):
+            out = reinsurance.by_policy(rbe, pol, self.treaty_df)
+        assert (out.claim != exp.claim).any()
+        for col in ['retention', 'claim', 'WXLR_metro', 'WXLR_rural']:
+            aac(out[col], np.round(exp[col], 6), rtol=1E-12)
+
+    def test_by_policies(self):
+        # all the policies at once, same numbers as in test_policy1/2/3
+        expected = _df('''\
+event_id,policy_id,retention,claim,WXLR_metro,WXLR_rural
+41,1,1078.0742,1078.0742,0.0,0.0
+40,1,1070.1654,1070.1654,0.0,0.0
+33,1,1017.8770,1017.8770,0.0,0.0
+13,1, 664.2781, 664.2781,0.0,0.0
+ 5,1, 661.1264, 661.1264,0.0,0.0
+27,2,200,2941.0974,2441.0974,300.0
+28,2,200,2936.3154,2436.3154,300.0
+26,2,200,2659.9182,2159.9182,300.0
+29,2,200,2403.0217,1903.0217,300.0
+23,2,200,1530.9891,1030.9891,300.0
+41,2,200, 978.0742, 478.0742,300.0
+40,2,200, 970.1654, 470.1654,300.0
+21,2,200, 957.2078, 457.2078,300.0
+13,2,200, 564.2781,  64.2781,300.0
+ 5,2,200, 561.1264,  61.1264,300.0
+25,3,700,8500, 3000,4800''')
+        # risk_by_event is not sorted by agg_id, so it is sorted internally
+        assert (np.diff(risk_by_event.agg_id) < 0).any()
+        got = reinsurance.by_policies(
+            risk_by_event, self.policy_df, self.treaty_df)
+        self.assertEqual(list(got.policy_grp), ['ABC'] * 15 + ['AB.'])
+        del got['policy_grp']
+        assert_ok(got, expected)
+
+        # already sorted input
+        sorted_df = risk_by_event.sort_values('agg_id', kind='stable')
+        got = reinsurance.by_policies(
+            sorted_df, self.policy_df, self.treaty_df)
+        del got['policy_grp']
+        assert_ok(got, expected)
+
     def test_by_cat_no_apply(self):
         expected = _df('''\
 event_id,retention,claim,WXLR_metro,WXLR_rural,CatXL_reg
@@ -268,7 +363,7 @@ event_id,claim,retention,prop1,nonprop1,overspill1,nonprop2
         _bypolicy, _byevent = by_policy_event(
             risk_by_event, pol_df, treaty_df)
 
-    def test_many_levels(self):
+    def check_many_levels(self, rtol=1E-7):
         treaty_df = _df('''\
 id,type,deductible,limit,code
 prop1,prop,   0,  90000,A
@@ -305,7 +400,35 @@ event_id,retention,claim,prop1,prop2,wxl1,wxl2,cat1,cat2,cat3,cat4,cat5,over_E,o
        1,   1000.0,40000.,17000.,4100,1600,1500,3800.,4200.,3800.,2500,500,2300,800''')
         _bypolicy, byevent = by_policy_event(
             risk_by_event, pol_df, treaty_df)
-        assert_ok(byevent, expected)
+        assert_ok(byevent, expected, rtol)
+
+    def test_many_levels(self):
+        self.check_many_levels()
+
+    def test_many_levels_fp32(self):
+        # by_event with float32 buffers, checking the result
+        with mock.patch.object(reinsurance, 'FP32', True), \
+                mock.patch.object(reinsurance, 'CHECK', True):
+            self.check_many_levels(rtol=1E-4)
+
+    def test_more_than_64_treaties(self):
+        # 64 wxlr treaties plus a catxl treaty; the codes of the treaties
+        # 60-64 ('!#$%&') sort before '.'
+        codes = general.BASE183[:65]
+        treaty_df = pandas.DataFrame(dict(
+            id=['wxl%d' % i for i in range(64)] + ['cat1'],
+            type=['wxlr'] * 64 + ['catxl'],
+            deductible=[0.] * 64 + [100.], limit=[1000.] * 64 + [600.],
+            code=list(codes)))
+        bypolicy = pandas.DataFrame(dict(
+            event_id=[1, 1], policy_id=[1, 2], retention=[1000., 500.],
+            claim=[1000., 500.], **{'wxl%d' % i: [0., 0.] for i in range(64)},
+            policy_grp=[codes, codes[:64] + '.']))
+        byevent = reinsurance.by_event(bypolicy, treaty_df)
+        self.assertEqual(byevent.retention[0], 1000.)
+        self.assertEqual(byevent.claim[0], 1500.)
+        self.assertEqual(byevent.cat1[0], 500.)
+        self.assertEqual(byevent['over_&'][0], 400.)
 
 
 #############################################################################
@@ -834,6 +957,20 @@ rur_Ant_1,10000,100,.1,.2''')
         self.assertIn('(row 3): a negative deductible was found',
                       str(ctx.exception))
 
+    def test_many_treaties(self):
+        # more than 64 treaties are accepted
+        treaties = ['prop%d' % i for i in range(65)]
+        csvfname = general.gettemp(
+            'policy,liability,deductible,%s\n' % ','.join(treaties) +
+            ''.join('%s,10000,100,%s\n' % (pol, ','.join(['0'] * 65))
+                    for pol in list(policy_idx)[1:]))
+        fields = ''.join('<field input="%s" />' % t for t in treaties)
+        xmlfname = general.gettemp(XML_PR.replace(
+            '<field oq="prop1" input="qshared" />', fields).replace(
+                '<field oq="prop2" input="surplus" />', '').format(csvfname))
+        _pol_df, treaty_df, _fmap = reinsurance.parse(xmlfname, policy_idx)
+        self.assertEqual(len(treaty_df), 65)
+
     def test_empty_liability(self):
         csvfname = general.gettemp('''\
 policy,liability,deductible,qshared,surplus
@@ -18,10 +18,12 @@
 
 import os
 import logging
+import functools
 import pandas as pd
 import numpy as np
+from numba import prange
 from openquake.baselib import hdf5
-from openquake.baselib.general import BASE183, fast_agg2, gen_slices
+from openquake.baselib.general import BASE183, gen_slices
 from openquake.baselib.performance import compile, Monitor
 from openquake.baselib.writers import scientificformat
 from openquake.hazardlib import nrml, InvalidFile
@@ -39,7 +41,19 @@ NOLIMIT = 1E100
 KNOWN_LOSS_TYPES = {
     'structural', 'nonstructural', 'contents',
     'value-structural', 'value-nonstructural', 'value-contents'}
-DEBUG = False
+# print the intermediate results of by_event
+DEBUG = bool(os.environ.get('OQ_REINSURANCE_DEBUG'))
+# round the cessions to 6 digits
+ROUND_OUTPUT = False
+# check that cessions + retention == claim (always done if DEBUG is set)
+CHECK = DEBUG or bool(os.environ.get('OQ_CHECK'))
+# use float32 buffers in by_event, halving the memory occupation
+FP32 = bool(os.environ.get('OQ_REINSURANCE_FP32'))
+# below these thresholds reins_by_policy is run without parallelization
+MIN_POLICIES = 32
+MIN_ROWS = 100_000
+# below this number of events apply_treaty is not parallelized
+MIN_PARALLEL = 4096
 VALID_TREATY_TYPES = 'prop', 'wxlr', 'catxl'
 
 
@@ -149,7 +163,12 @@ def check_treaties(fields, dframe, policyidx, fname, policyfname,
                     policyfname, i+2, np.round(treaty_sum, 5)))
     # replace policy names with policy indices starting from 1
     key = fields[0]
-    dframe[key] = [policyidx[pol] for pol in dframe[key]]
+    idxs = dframe[key].map(policyidx)
+    if idxs.isna().any():
+        missing = dframe[key][idxs.isna()].iloc[0]
+        raise InvalidFile(
+            f'{policyfname}: policy "{missing}" is not in the exposure')
+    dframe[key] = idxs.to_numpy(np.int64)
     for no, field in enumerate(fields):
         if field not in dframe.columns:
             raise InvalidFile(f'{fname}: {field} is missing in the header')
@@ -185,28 +204,32 @@ def check_fractions(colnames, colvalues, fname):
     Make sure the sum of the proportional fractions is below 1 and raise
     a clear error if not.
     """
-    n = len(colvalues[0])
-    for i in range(n):
-        tot = 0
-        for c, col in enumerate(colnames):
-            frac = colvalues[c][i]
-            if frac > 1 or frac < 0:
-                raise ValueError(
-                    f'{fname}:{i+2}: invalid fraction {col}={frac}')
-            tot += frac
-        if tot > 1:
-            raise ValueError(f'{fname}:{i+2} the sum of the fractions must be '
-                             f'under 1, got {tot}')
-
-
-def parse(fname, policy_idx):
-    """
-    :param fname: XML file containing the treaties metadata
-    :param policy_idx: dictionary policy name -> policy index
-
-    Parse a reinsurance.xml file and returns
-    (policy_df, treaty_df, field_map)
-    """
+    arr = np.array(colvalues)  # shape (C, n)
+    bad = (arr > 1) | (arr < 0)
+    tot = arr.sum(axis=0)
+    [bad_rows] = np.where(bad.any(axis=0))
+    [big_rows] = np.where(tot > 1)
+    # report the first row with an error, invalid fractions first
+    if len(bad_rows) and (not len(big_rows) or bad_rows[0] <= big_rows[0]):
+        i = bad_rows[0]
+        c = np.argmax(bad[:, i])
+        raise ValueError(
+            f'{fname}:{i+2}: invalid fraction {colnames[c]}={arr[c, i]}')
+    if len(big_rows):
+        i = big_rows[0]
+        raise ValueError(f'{fname}:{i+2} the sum of the fractions must be '
+                         f'under 1, got {tot[i]}')
+
+
+def _stamp(fname):
+    # used to invalidate the caches when a file changes
+    st = os.stat(fname)
+    return st.st_mtime_ns, st.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _read_model(fname, stamp):
+    # read the reinsurance.xml file; stamp is there to invalidate the cache
     rmodel = nrml.read(fname).reinsuranceModel
     fieldmap = {}
     fmap = {}  # ex: {'deductible': 'Deductible', 'liability': 'Limit'}
@@ -241,6 +264,16 @@ def parse(fname, policy_idx):
         treaty['limit'].append(limit)
         treaty_linenos.append(node.lineno)
     policyfname = os.path.join(os.path.dirname(fname), ~rmodel.policies)
+    return (policyfname, fieldmap, fmap, treaty, treaty_linenos,
+            nonprop, colnames)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse(fname, stamp, pstamp, policy_items):
+    # pstamp is the stamp of the policy file
+    (policyfname, fieldmap, fmap, treaty, treaty_linenos,
+     nonprop, colnames) = _read_model(fname, stamp)
+    policy_idx = dict(policy_items)
     df = pd.read_csv(policyfname).rename(columns=fieldmap)
     df.columns = df.columns.str.strip()
     all_policies = df.policy.to_numpy()  # ex ['A', 'B']
@@ -266,117 +299,303 @@ def parse(fname, policy_idx):
     return df, treaty_df, fmap
 
 
+def parse(fname, policy_idx):
+    """
+    :param fname: XML file containing the treaties metadata
+    :param policy_idx: dictionary policy name -> policy index
+
+    Parse a reinsurance.xml file and returns
+    (policy_df, treaty_df, field_map). The results are cached
+    until the XML file or the policy file are modified.
+    """
+    stamp = _stamp(fname)
+    pstamp = _stamp(_read_model(fname, stamp)[0])
+    df, treaty_df, fmap = _parse(
+        fname, stamp, pstamp, tuple(policy_idx.items()))
+    # return copies, so that the cached objects cannot be modified
+    return df.copy(), treaty_df.copy(), dict(fmap)
+
+
 @compile(["(float64[:],float64[:],float64,float64)",
           "(float64[:],float32[:],float64,float64)",
-          "(float32[:],float32[:],float64,float64)"])
+          "(float32[:],float32[:],float64,float64)"],
+         boundscheck=False, fastmath=True, parallel=True)
 def apply_treaty(cession, retention, deduc, capacity):
-    for i, ret in np.ndenumerate(retention):
-        overmax = ret - deduc
-        if ret > deduc:
-            if overmax > capacity:
-                retention[i] = deduc + overmax - capacity
-                cession[i] = capacity
-            else:
-                retention[i] = deduc
-                cession[i] = overmax
+    # NB: the loops are written without branches so that numba can
+    # vectorize them
+    n = retention.shape[0]
+    if n < MIN_PARALLEL:  # spawning threads would be slower
+        for i in range(n):
+            ret = retention[i]
+            ces = min(max(ret - deduc, 0.), capacity)
+            cession[i] = ces
+            retention[i] = ret - ces
+    else:
+        for i in prange(n):
+            ret = retention[i]
+            ces = min(max(ret - deduc, 0.), capacity)
+            cession[i] = ces
+            retention[i] = ret - ces
+
+
+@compile("(float64[:],float64[:,:],boolean[:,:],float64[:],float64[:],"
+         "float64[:,:],boolean)", boundscheck=False, fastmath=True)
+def _fill_cessions(claim, fracs, flags, deducs, limits, out, rnd):
+    # fill in a single pass the matrix out of shape (N, 2 + P + W) with
+    # retention, claim, P proportional and W wxlr cessions, possibly
+    # rounded to 6 digits
+    P = fracs.shape[0]
+    W = flags.shape[0]
+    for i in range(claim.shape[0]):
+        c = claim[i]
+        tot = 0.
+        for t in range(P):
+            tot += fracs[t, i]
+            out[i, 2 + t] = c * fracs[t, i]
+        ret = c * (1. - tot)
+        for t in range(W):
+            ces = 0.
+            if flags[t, i]:
+                ces = min(max(ret - deducs[t], 0.), limits[t] - deducs[t])
+                ret -= ces
+            out[i, 2 + P + t] = ces
+        out[i, 0] = ret
+        out[i, 1] = c
+        if rnd:
+            for j in range(out.shape[1]):
+                out[i, j] = np.rint(out[i, j] * 1E6) / 1E6
 
 
 def claim_to_cessions(claim, policy, treaty_df):
     """
-    :param claim: an array of claims
-    :param policy: a dictionary corresponding to a specific policy
+    :param claim: an array of N claims
+    :param policy: a dictionary column -> array of values, one per claim
     :param treaty_df: dataframe with treaties
+    :returns: the column names and a matrix of shape (N, 2 + P + W)
 
-    Converts an array of claims into a dictionary of arrays.
+    Converts an array of claims into a matrix with retention, claim,
+    P proportional cessions and W wxlr cessions.
     """
-    # proportional cessions
-    cols = treaty_df[treaty_df.type == 'prop'].id
-    fractions = [policy[col] for col in cols]
-    assert sum(fractions) <= 1
-    out = {'retention': claim * (1. - sum(fractions)), 'claim': claim}
-    for col, frac in zip(cols, fractions):
-        out[col] = claim * frac
-
-    # wxlr cessions, totally independent from the overspill
+    N = len(claim)
+    prop = treaty_df[treaty_df.type == 'prop']
+    # the wxlr cessions are totally independent from the overspill
     wxl = treaty_df[treaty_df.type == 'wxlr']
-    for col, deduc, limit in zip(wxl.id, wxl.deductible, wxl.limit):
-        out[col] = np.zeros(len(claim))
-        if policy[col]:
-            apply_treaty(out[col], out['retention'], deduc, limit - deduc)
-
-    return {k: np.round(v, 6) for k, v in out.items()}
-
-
-def build_policy_grp(policy, treaty_df):
+    fracs = np.array([policy[col] for col in prop.id], float).reshape(
+        len(prop), N)
+    assert (fracs.sum(axis=0) <= 1).all()
+    flags = np.array([policy[col] for col in wxl.id], bool).reshape(
+        len(wxl), N)
+    out = np.zeros((N, 2 + len(prop) + len(wxl)))
+    _fill_cessions(np.asarray(claim, float), fracs, flags,
+                   wxl.deductible.to_numpy(float),
+                   wxl.limit.to_numpy(float), out, ROUND_OUTPUT)
+    cols = ['retention', 'claim'] + list(prop.id) + list(wxl.id)
+    return cols, out
+
+
+def build_policy_grps(policy_df, treaty_df):
     """
-    :param policy: policy dictionary
+    :param policy_df: policy DataFrame
     :param treaty_df: treaty DataFrame
-    :returns: the policy_grp for the given policy
+    :returns: an array with the policy_grp for each policy
     """
-    cols = treaty_df.id.to_numpy()
-    codes = treaty_df.code.to_numpy()
-    types = treaty_df.type.to_numpy()
-    key = list(codes)
-    for c, col in enumerate(cols):
-        if types[c] == 'catxl' and policy[col] == 0:
-            key[c] = '.'
-    return ''.join(key)
+    T = len(treaty_df)
+    if T == 0:
+        return np.full(len(policy_df), '')
+    codes = treaty_df.code.to_numpy().astype('U1')
+    catxl = treaty_df.type.to_numpy() == 'catxl'
+    grid = np.tile(codes, (len(policy_df), 1))  # shape (P, T)
+    active = policy_df[treaty_df.id[catxl]].to_numpy() != 0
+    grid[:, catxl] = np.where(active, codes[catxl], '.')
+    return grid.view(f'U{T}')[:, 0]
 
 
 def line(row, fmt='%d'):
     return ''.join(scientificformat(val, fmt).rjust(11) for val in row)
 
 
-def clever_agg(ukeys, datalist, treaty_df, idx, overdict, eids):
+def encode_policy_grps(grps, codes):
+    """
+    :param grps: an array of N policy_grp strings of length T
+    :param codes: the T treaty codes
+    :returns: an array of uint64 keys of shape (N, W), with W = ceil(T/64)
+
+    Encode the policy groups as bitmasks: the treaty t corresponds to the
+    bit 63 - t % 64 of the word t // 64, which is set iff the t-th
+    character of the policy_grp sorts after '.'. Since each character is
+    either '.' or the treaty code, the lexicographic ordering of the keys
+    matches the ordering of the strings; for the codes sorting after '.'
+    (e.g. 'A'...'}' and '/', '0'...) a set bit means an active treaty, for
+    the others (like '!' or '#') an inactive treaty (see _is_active):
+
+    >>> encode_policy_grps(['AB.', 'A.C', '...'], 'ABC') >> np.uint64(61)
+    array([[6],
+           [5],
+           [0]], dtype=uint64)
+    >>> encode_policy_grps(['A!', 'A.'], 'A!') >> np.uint64(62)
+    array([[2],
+           [3]], dtype=uint64)
+    """
+    T = len(codes)
+    W = max(1, -(-T // 64))
+    keys = np.zeros((len(grps), W), np.uint64)
+    if T == 0:
+        return keys
+    chars = np.array(grps, f'U{T}').view('U1').reshape(-1, T)
+    bits = (chars != '.') != (np.array(list(codes)) < '.')
+    for w in range(W):
+        block = bits[:, w * 64: (w + 1) * 64]
+        weights = np.uint64(1) << np.arange(
+            63, 63 - block.shape[1], -1, dtype=np.uint64)
+        keys[:, w] = (block * weights).sum(axis=1, dtype=np.uint64)
+    return keys
+
+
+def _is_active(keys, level, code):
+    # returns a boolean array with the groups where the treaty is active
+    bit = np.uint64(1) << np.uint64(63 - level % 64)
+    return ((keys[:, level // 64] & bit) != 0) != (code < '.')
+
+
+@compile(["boolean(float64[:,:,:],boolean[:],int64,int64,"
+          "float64,float64,float64[:])",
+          "boolean(float32[:,:,:],boolean[:],int64,int64,"
+          "float64,float64,float64[:])"], boundscheck=False, fastmath=True)
+def _apply_level(work, active, c, ttype, deduc, limit, over):
+    # apply the treaty of type ttype (0=prop, 1=wxlr, 2=catxl) to the
+    # active groups, where work[g, 0] is the retention and
+    # work[g, c] the cession; store the overspill of the last group having
+    # it in the over array and returns True if there is an overspill
+    capacity = limit - deduc
+    E = work.shape[2]
+    overspill = np.zeros(E)
+    found = False
+    for g in range(len(active)):
+        if ttype == 1 or not active[g]:  # wxlr are already applied
+            continue
+        ret = work[g, 0]
+        cession = work[g, c]
+        has_over = False
+        if ttype == 2:  # catxl
+            for i in range(E):
+                overspill[i] = max(ret[i] - deduc - capacity, 0.)
+                has_over |= overspill[i] > 0.
+            apply_treaty(cession, ret, deduc, capacity)
+        else:  # prop
+            for i in range(E):
+                overspill[i] = max(cession[i] - capacity, 0.)
+                if overspill[i] > 0.:
+                    has_over = True
+                    ret[i] += cession[i] - limit
+                    cession[i] = limit
+        if has_over:
+            over[:] = overspill
+            found = True
+    return found
+
+
+def clever_agg(ukeys, datalist, tr_params, idx, overdict, eids):
     """
-    :param ukeys: a list of unique keys
-    :param datalist: a list of matrices of the shape (E, 2+T)
-    :param treaty_df: a treaty DataFrame
+    :param ukeys: a (G, W) array of unique keys (see encode_policy_grps)
+    :param datalist: a list of matrices of the shape (2+T, E)
+    :param tr_params: a dictionary code -> (type index, deductible, limit)
     :param idx: a dictionary treaty.code -> cession index
     :param overdic: a dictionary treaty.code -> overspill array
 
-    Recursively compute cessions and retentions for each treaty.
+    Compute cessions and retentions for each treaty, one level at the time,
+    by working in place on a single (G, 2+T, E) buffer and merging the
+    groups differing only by the bit of the current treaty after each level
+    (the bit is set to the value meaning inactive).
     Populate the cession dictionary and returns the final retention.
     """
-    if DEBUG:
-        print()
-        print(line(['event_id', 'policy_grp'] + list(idx)))
-        rows = []
-        for key, data in zip(ukeys, datalist):
-            # printing the losses
-            for eid, row in zip(eids, data):
-                rows.append([eid, key] + list(row))
-        for row in sorted(rows):
-            print(line(row))
-    if len(ukeys) == 1 and ukeys[0] == '':
-        return datalist[0]
-    newkeys, newdatalist = [], []
-    for key, data in zip(ukeys, datalist):
-        code = key[0]
-        newkey = key[1:]
-        if code != '.':
-            tr = treaty_df.loc[code]
-            ret = data[:, idx['retention']]
-            cession = data[:, idx[code]]
-            capacity = tr.limit - tr.deductible
-            has_over = False
-            if tr.type == 'catxl':
-                overspill = ret - tr.deductible - capacity
-                has_over = (overspill > 0).any()
-                apply_treaty(cession, ret, tr.deductible, capacity)
-            elif tr.type == 'prop':
-                overspill = cession - capacity
-                over = overspill > 0
-                has_over = (overspill > 0).any()
-                if has_over:
-                    ret[over] += cession[over] - tr.limit
-                    cession[over] = tr.limit
-            if has_over:
-                overdict['over_' + code] = np.maximum(overspill, 0)
-        newkeys.append(newkey)
-        newdatalist.append(data)
-    keys, sums = fast_agg2(newkeys, np.array(newdatalist))
-    return clever_agg(keys, sums, treaty_df, idx, overdict, eids)
+    keys = np.array(ukeys, np.uint64)
+    work = np.array(datalist)
+    for level, code in enumerate(tr_params):
+        ttype, deduc, limit = tr_params[code]
+        over = np.zeros(len(eids))
+        if _apply_level(work, _is_active(keys, level, code), idx[code],
+                        ttype, deduc, limit, over):
+            overdict['over_' + code] = over
+        # merge the groups which differ only by the current bit
+        bit = np.uint64(1) << np.uint64(63 - level % 64)
+        if code < '.':
+            keys[:, level // 64] |= bit
+        else:
+            keys[:, level // 64] &= ~bit
+        keys, inv = np.unique(keys, axis=0, return_inverse=True)
+        inv = inv.reshape(-1)
+        summed = np.zeros((len(keys),) + work.shape[1:], work.dtype)
+        for g, k in enumerate(inv):  # much faster than np.add.at
+            summed[k] += work[g]
+        work = summed
+    return work[0]
+
+
+def _debug_dump_impl(keys, work, idx, eids, codes):
+    # print the losses for each policy group
+    actives = [_is_active(keys, t, code) for t, code in enumerate(codes)]
+    print()
+    print(line(['event_id', 'policy_grp'] + list(idx)))
+    rows = []
+    for g, data in enumerate(work):
+        grp = ''.join(code if actives[t][g] else '.'
+                      for t, code in enumerate(codes))
+        # printing the losses
+        for eid, row in zip(eids, data.T):
+            rows.append([eid, grp] + list(row))
+    for row in sorted(rows):
+        print(line(row))
+
+
+# bound at import time, so that there is no cost when DEBUG is not set
+_debug_dump = _debug_dump_impl if DEBUG else lambda *args: None
+
+
+def by_policies(rbe, policy_df, treaty_df):
+    '''
+    :param rbe:
+        DataFrame or dictionary of arrays with fields event_id, agg_id, loss
+    :param DataFrame policy_df:
+        Policy parameters, with policy_df.policy being integers >= 1
+    :param DataFrame treaty_df:
+        All treaties
+    :returns:
+        DataFrame of reinsurance losses by event ID and policy ID
+    '''
+    policy = policy_df.policy.to_numpy().astype(int)
+    agg_id = np.asarray(rbe['agg_id'])
+    # sort the rows by agg_id, preserving the original order of the events
+    if (agg_id[1:] >= agg_id[:-1]).all():
+        order = np.arange(len(agg_id))
+    else:
+        order = np.argsort(agg_id, kind='stable')
+    sorted_ids = agg_id[order]
+    starts = np.searchsorted(sorted_ids, policy - 1, 'left')
+    counts = np.searchsorted(sorted_ids, policy - 1, 'right') - starts
+    # pos is the position in policy_df of each selected row
+    pos = np.repeat(np.arange(len(policy)), counts)
+    offsets = np.cumsum(counts) - counts
+    rows = order[np.arange(len(pos)) + np.repeat(starts - offsets, counts)]
+    losses = np.asarray(rbe['loss'])[rows]
+    ded = policy_df.deductible.to_numpy()[pos]
+    lim = policy_df.liability.to_numpy()[pos]
+    claim = scientific.insured_losses(losses, ded, lim)
+    pol = {col: policy_df[col].to_numpy()[pos]
+           for col, typ in zip(treaty_df.id, treaty_df.type)
+           if typ != 'catxl'}
+    cols, out = claim_to_cessions(claim, pol, treaty_df)
+    [nonzero] = np.where(claim > 0)  # discard zero claims
+    # filter all the float columns at once, keeping a single block
+    rbp = pd.DataFrame(out[nonzero], columns=cols)
+    rbp.insert(0, 'event_id', np.asarray(rbe['event_id'])[rows[nonzero]])
+    rbp.insert(1, 'policy_id', policy[pos[nonzero]])
+    # ex: event_id, policy_id, retention, claim, surplus, quota_shared, wxlr
+    if 'policy_grp' in policy_df.columns:  # precomputed
+        grps = policy_df.policy_grp.to_numpy()
+    else:
+        grps = build_policy_grps(policy_df, treaty_df)
+    rbp['policy_grp'] = grps[pos[nonzero]]
+    return rbp
 
 
 # tested in reinsurance_test.py
@@ -391,19 +610,7 @@ def by_policy(rbe, pol_dict, treaty_df):
     :returns:
         DataFrame of reinsurance losses by event ID and policy ID
     '''
-    out = {}
-    df = rbe[rbe.agg_id == pol_dict['policy'] - 1]
-    losses = df.loss.to_numpy()
-    ded, lim = pol_dict['deductible'], pol_dict['liability']
-    claim = scientific.insured_losses(losses, ded, lim)
-    out['event_id'] = df.event_id.to_numpy()
-    out['policy_id'] = np.array([pol_dict['policy']] * len(df), int)
-    out.update(claim_to_cessions(claim, pol_dict, treaty_df))
-    nonzero = out['claim'] > 0  # discard zero claims
-    rbp = pd.DataFrame({k: out[k][nonzero] for k in out})
-    # ex: event_id, policy_id, retention, claim, surplus, quota_shared, wxlr
-    rbp['policy_grp'] = build_policy_grp(pol_dict, treaty_df)
-    return rbp
+    return by_policies(rbe, pd.DataFrame([pol_dict]), treaty_df)
 
 
 # called by post_risk
@@ -411,42 +618,58 @@ def by_event(rbp, treaty_df, mon=Monitor()):
     with mon('processing reinsurance by policy', measuremem=True):
         # this is very fast
         tdf = treaty_df.set_index('code')
-        inpcols = ['eid', 'claim'] + [t.id for _, t in tdf.iterrows()
-                                      if t.type != 'catxl']
+        inpcols = ['claim'] + [tid for tid, typ in zip(tdf.id, tdf.type)
+                               if typ != 'catxl']
         outcols = ['retention', 'claim'] + list(tdf.index)
         idx = {col: i for i, col in enumerate(outcols)}
         eids, idxs = np.unique(rbp.event_id.to_numpy(), return_inverse=True)
-        rbp['eid'] = idxs
         E = len(eids)
         dic = dict(event_id=eids)
-        keys, datalist = [], []
-        for key, grp in rbp.groupby('policy_grp'):
+        grps = rbp.policy_grp.to_numpy()
+        keys, inv = np.unique(encode_policy_grps(grps, tdf.index), axis=0,
+                              return_inverse=True)
+        inv = inv.reshape(-1)
+        # split the row indices by policy group
+        allrows = np.split(np.argsort(inv, kind='stable'),
+                           np.cumsum(np.bincount(inv))[:-1])
+        values = {col: rbp[col].to_numpy() for col in inpcols}
+        datalist = []
+        for rows in allrows:
             logging.info('Processing policy group %r with %d rows',
-                         key, len(grp))
-            data = np.zeros((E, len(outcols)))
-            gb = grp[inpcols].groupby('eid').sum()
-            for i, col in enumerate(inpcols):
-                if i > 0:  # claim, noncat1, ...
-                    data[gb.index, i] = gb[col].to_numpy()
-            data[:, 0] = data[:, 1]  # retention = claim - noncats
+                         grps[rows[0]], len(rows))
+            # one row per column, so that each column is contiguous
+            data = np.zeros((len(outcols), E), np.float32 if FP32 else float)
+            eidx = idxs[rows]
+            for i, col in enumerate(inpcols, 1):  # claim, noncat1, ...
+                data[i] = np.bincount(eidx, values[col][rows], minlength=E)
+            data[0] = data[1]  # retention = claim - noncats
             for c in range(2, len(outcols)):
-                data[:, 0] -= data[:, c]
-            keys.append(key)
+                data[0] -= data[c]
             datalist.append(data)
-        del rbp['eid'], rbp['policy_grp']
+        del rbp['policy_grp']
 
     with mon('reinsurance by event', measuremem=True):
         # this is fast
         overspill = {}
-        res = clever_agg(keys, datalist, tdf, idx, overspill, eids)
-
-        # sanity check on the result
-        ret = res[:, 0]
-        claim = res[:, 1]
-        cession = res[:, 2:].sum(axis=1)
-        np.testing.assert_allclose(cession + ret, claim)
-
-        dic.update({col: res[:, c] for c, col in enumerate(outcols)})
+        _debug_dump(keys, datalist, idx, eids, list(tdf.index))
+        # treaty parameters in the order of the levels
+        tr_params = {code: (VALID_TREATY_TYPES.index(typ), float(ded),
+                            float(lim))
+                     for code, typ, ded, lim in zip(
+                         tdf.index, tdf.type, tdf.deductible, tdf.limit)}
+        res = clever_agg(keys, datalist, tr_params, idx, overspill, eids)
+        _debug_dump(encode_policy_grps(['.' * len(tdf)], tdf.index), [res],
+                    idx, eids, list(tdf.index))
+
+        if CHECK:  # sanity check on the result
+            ret = res[0]
+            claim = res[1]
+            cession = res[2:].sum(axis=0)
+            np.testing.assert_allclose(
+                cession + ret, claim, rtol=1E-4 if FP32 else 1E-7)
+
+        dic.update({col: res[c].astype(np.float64)
+                    for c, col in enumerate(outcols)})
         dic.update(overspill)
         alias = dict(zip(tdf.index, tdf.id))
         df = pd.DataFrame(dic).rename(columns=alias)
@@ -458,15 +681,15 @@ def reins_by_policy(dstore, policy_df, treaty_df, loss_id, monitor):
     Task function called by post_risk
     """
     rbe_mon = monitor('reading risk_by_event')
-    policies = [dict(policy) for _, policy in policy_df.iterrows()]
     dfs = []
     with dstore:
         nrows = len(dstore['risk_by_event/agg_id'])
         for slc in gen_slices(0, nrows, hdf5.MAX_ROWS):
             with rbe_mon:
-                rbe_df = dstore.read_df(
-                    'risk_by_event', sel={'loss_id': loss_id}, slc=slc)
-            for policy in policies:
-                dfs.append(by_policy(rbe_df, policy, treaty_df))
+                # read only the needed columns
+                rbe = hdf5.extract_cols(
+                    dstore['risk_by_event'], {'loss_id': loss_id}, [slc],
+                    ['event_id', 'agg_id', 'loss'])
+            dfs.append(by_policies(rbe, policy_df, treaty_df))
     if dfs:
         yield pd.concat(dfs)